@@ -1,20 +1,133 @@
+import heapq
 import re
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import repeat
 
 import numpy as np
 import pandas as pd
-from pathos.multiprocessing import ProcessPool
 from tqdm import tqdm
 
 from nlstruct.core.cache import cached
 from nlstruct.core.text import join_cols
 
+_match_span = re.Match.span
+
+# Texts being split by regex_sentencize, only set in its worker processes
+_worker_texts = None
+
+
+@lru_cache(maxsize=None)
+def _make_sentence_regexes(reg_split, reg_token):
+    """
+    Compile the patterns used to find the separators and the tokens of a text, once per pair of patterns
+
+    Returns
+    -------
+    (re.Pattern, re.Pattern)
+        separator and token patterns
+    """
+    reg_sep = r"(?P<sep>{})".format(reg_split)
+    # When the separator starts with \s* (and has no alternative), it matches inside a run of spaces only if it
+    # matches at the start of the run. The runs of spaces that do not hold a separator are then consumed at once,
+    # otherwise the separator pattern would be retried (and backtrack) at every position of the run, which is
+    # quadratic in the length of the run (ex: space aligned tables)
+    start = re.match(r"(?:\((?:\?:|\?P<\w+>)?)*", reg_split).end()
+    if "|" not in reg_split and reg_split.startswith(r"\s*", start) and not reg_split.startswith(r"\s*+", start):
+        reg_sep += r"|[^\S\n]{2,}"
+        # If it also starts with \s*\n (and no group can be skipped), every match starts with a whitespace
+        # and the other positions are skipped without trying the pattern
+        if re.match(r"\\s\*\\n(?![*?{])", reg_split[start:]) and not re.search(r"\)(?:[*?]|\{0)", reg_split):
+            reg_sep = r"(?=\s)(?:{})".format(reg_sep)
+    return re.compile(reg_sep), re.compile(reg_token)
+
+
+def _sentencize_spans(texts, max_sentence_length, min_sentence_length, reg_split, reg_token, with_tqdm=False):
+    """
+    Find the sentence bounds of a list of texts
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray, np.ndarray, int, int)
+        begins and ends of the sentences, number of sentences per text, max and min sentence sizes
+    """
+    reg_sep, reg_token = _make_sentence_regexes(reg_split, reg_token)
+    # Only the spans are collected in the loop, the sentences are sliced out of the texts afterwards
+    begins = array('q')
+    ends = array('q')
+    sentence_counts = array('q')
+    max_size = 0
+    min_size = 10000000
+    for txt in (tqdm(texts, desc="Splitting docs into sentences", mininterval=0.5, smoothing=0) if with_tqdm else texts):
+        n_before = len(begins)
+        part_bounds = [0]
+        for match in reg_sep.finditer(txt):
+            if match.lastgroup == "sep":
+                part_bounds.extend(match.span())
+        part_bounds.append(len(txt))
+        # Parts are chunked one at a time: holding the spans of a whole doc (or of several docs, to chunk
+        # them with numpy) measured slower than this loop, which only runs once per sentence
+        queued_spans = []
+        for part_begin, part_end in zip(part_bounds[::2], part_bounds[1::2]):
+            # Tokens are only looked for between the separators, in place in the text. A single scan of an
+            # alternation of both patterns would dispatch every token in Python, which is slower than collecting
+            # the spans of each part with finditer
+            spans = list(map(_match_span, reg_token.finditer(txt, part_begin, part_end)))
+            if queued_spans:
+                spans = queued_spans + spans
+            n_tokens = len(spans)
+            if not n_tokens:
+                continue
+            step = max_sentence_length or n_tokens
+            last_size = n_tokens % step or step
+            # A last sentence shorter than min_sentence_length is carried over to the next part (dropped after the last one)
+            cut = n_tokens - last_size if min_sentence_length is not None and last_size < min_sentence_length else n_tokens
+            for first in range(0, cut, step):
+                begins.append(spans[first][0])
+                ends.append(spans[min(first + step, cut) - 1][1])
+            if cut:
+                max_size, min_size = max(max_size, min(step, cut)), min(min_size, (cut - 1) % step + 1)
+            queued_spans = spans[cut:]
+        sentence_counts.append(len(begins) - n_before)
+    return np.frombuffer(begins, dtype=np.int64), np.frombuffer(ends, dtype=np.int64), np.frombuffer(sentence_counts, dtype=np.int64), max_size, min_size
+
+
+def _balance_bins(sizes, n_bins):
+    """
+    Distribute items into `n_bins` bins of roughly equal total size, by adding the
+    largest remaining item to the currently smallest bin
+
+    Returns
+    -------
+    list of np.ndarray
+        sorted indices of the items of each bin
+    """
+    bins = [[] for _ in range(n_bins)]
+    heap = [(0, k) for k in range(n_bins)]
+    for i, size in zip(np.argsort(-sizes, kind="stable").tolist(), np.sort(sizes)[::-1].tolist()):
+        bin_size, k = heap[0]
+        bins[k].append(i)
+        heapq.heapreplace(heap, (bin_size + size, k))
+    return [np.sort(np.asarray(indices, dtype=np.int64)) for indices in bins]
+
+
+def _set_worker_texts(texts):
+    global _worker_texts
+    _worker_texts = texts
+
+
+def _sentencize_worker_spans(doc_indices, *args):
+    return _sentencize_spans([_worker_texts[i] for i in doc_indices], *args)
+
 
 def regex_sentencize(docs, max_sentence_length=None, min_sentence_length=None, n_threads=1,
                      reg_split=r"((?:\s*\n)+\s*)",
                      reg_token=r"[\w*]+|[^\w\s\n*]",
                      text_col="text",
                      doc_id_col="doc_id",
-                     with_tqdm=False, verbose=0):
+                     with_tqdm=False, verbose=0,
+                     include_text=True, doc_id_dtype=None):
     """
     Simple split MIMIC docs into sentences:
     - sentences bounds are found when multiple newline occurs
@@ -28,90 +141,113 @@ def regex_sentencize(docs, max_sentence_length=None, min_sentence_length=None, n
     verbose: int
     doc_id_col: str
     text_col: str
+    include_text: bool
+        Add the text of each sentence in a "text" column, otherwise only the
+        begin/end offsets of the sentences in their doc are returned
+    doc_id_dtype: pd.CategoricalDtype
+        Categories of the doc ids of the sentences, built from the doc ids of `docs` if None
 
     Returns
     -------
     (np.ndarray, np.ndarray, np.ndarray)
     """
     n_threads = min(n_threads, len(docs))
+    texts = docs[text_col].tolist()
     if n_threads > 1:
-        text_chunks = np.array_split(np.arange(len(docs)), n_threads)
-        pool = ProcessPool(nodes=n_threads)
-        pool.restart(force=True)
-        results = [pool.apipe(regex_sentencize, docs.iloc[chunk], max_sentence_length, 1, with_tqdm=False) for chunk in text_chunks]
-        results = [r.get() for r in results]
-        pool.close()
-        return pd.concat(results, ignore_index=True)
-
-    reg_split = re.compile(reg_split)
-    reg_token = re.compile(reg_token)
-    doc_ids = []
-    sentence_idx_list = []
-    begins = []
-    ends = []
-    sentences = []
-    max_size = 0
-    min_size = 10000000
-    for doc_id, txt in zip(docs[doc_id_col], (tqdm(docs[text_col], desc="Splitting docs into sentences") if with_tqdm else docs[text_col])):
-        idx = 0
-        queued_spans = []
-        sentence_idx = 0
-        for i, part in enumerate(reg_split.split(txt)):
-            if i % 2 == 0:  # we're in a sentence
-                queued_spans.extend([(m.start() + idx, m.end() + idx) for m in reg_token.finditer(part)])
-                if max_sentence_length is None:
-                    max_sentence_length_ = len(queued_spans)
-                else:
-                    max_sentence_length_ = max_sentence_length
-                while len(queued_spans) > max_sentence_length_:
-                    b = queued_spans[0][0]
-                    e = queued_spans[max_sentence_length_ - 1][1]
-                    doc_ids.append(doc_id)
-                    sentence_idx_list.append(sentence_idx)
-                    begins.append(b)
-                    ends.append(e)
-
-                    max_size, min_size = max(max_size, max_sentence_length_), min(min_size, max_sentence_length_)
-                    queued_spans = queued_spans[max_sentence_length_:]
-                    sentences.append(txt[b:e])
-                    sentence_idx += 1
-                if min_sentence_length is not None and len(queued_spans) < min_sentence_length:
-                    idx += len(part)
-                    continue
-                if len(queued_spans):
-                    b = queued_spans[0][0]
-                    e = queued_spans[-1][1]
-                    doc_ids.append(doc_id)
-                    sentence_idx_list.append(sentence_idx)
-                    begins.append(b)
-                    ends.append(e)
-                    max_size, min_size = max(max_size, len(queued_spans)), min(min_size, len(queued_spans))
-                    queued_spans = []
-                    sentences.append(txt[b:e])
-                    sentence_idx += 1
-            if part is not None:
-                idx += len(part)
+        # Workers only return the spans, the dataframe is rebuilt here
+        # Note lengths span several orders of magnitude, so docs are balanced on their number of characters
+        doc_chunks = _balance_bins(np.fromiter(map(len, texts), dtype=np.int64, count=len(texts)), n_threads)
+        # The texts are given to the workers when they start (inherited when they are forked, pickled once per
+        # worker otherwise), and only the indices of their docs are sent with each task
+        with ProcessPoolExecutor(max_workers=n_threads, initializer=_set_worker_texts, initargs=(texts,)) as executor:
+            results = list(executor.map(_sentencize_worker_spans, doc_chunks,
+                                        repeat(max_sentence_length), repeat(min_sentence_length), repeat(reg_split), repeat(reg_token)))
+        sentence_counts = np.zeros(len(texts), dtype=np.int64)
+        for chunk, (_, _, chunk_sentence_counts, _, _) in zip(doc_chunks, results):
+            sentence_counts[chunk] = chunk_sentence_counts
+        first_sentences = np.cumsum(sentence_counts) - sentence_counts
+        # The spans of each worker are written at the offsets of their docs, in the order of the docs
+        begins = np.empty(first_sentences[-1] + sentence_counts[-1], dtype=np.int64)
+        ends = np.empty_like(begins)
+        for chunk, (chunk_begins, chunk_ends, chunk_sentence_counts, _, _) in zip(doc_chunks, results):
+            chunk_first_sentences = np.cumsum(chunk_sentence_counts) - chunk_sentence_counts
+            positions = np.repeat(first_sentences[chunk] - chunk_first_sentences, chunk_sentence_counts) + np.arange(len(chunk_begins))
+            begins[positions] = chunk_begins
+            ends[positions] = chunk_ends
+        max_size, min_size = max(result[3] for result in results), min(result[4] for result in results)
+    else:
+        begins, ends, sentence_counts, max_size, min_size = _sentencize_spans(texts, max_sentence_length, min_sentence_length, reg_split, reg_token, with_tqdm=with_tqdm)
     if verbose:
         print("Sentence size: max = {}, min = {}".format(max_size, min_size))
+    first_sentences = np.repeat(np.cumsum(sentence_counts) - sentence_counts, sentence_counts)
+    # Each doc id is stored once in the categories, sentences only hold its code
+    if doc_id_dtype is not None:
+        doc_codes = pd.Categorical(docs[doc_id_col], dtype=doc_id_dtype).codes
+    elif hasattr(docs[doc_id_col], 'cat'):
+        doc_codes, doc_id_dtype = docs[doc_id_col].cat.codes.values, docs[doc_id_col].dtype
+    else:
+        doc_codes, doc_ids = pd.factorize(docs[doc_id_col])
+        doc_id_dtype = pd.CategoricalDtype(doc_ids)
     df = pd.DataFrame({
-        doc_id_col: doc_ids,
-        "sentence_idx": sentence_idx_list,
+        doc_id_col: pd.Categorical.from_codes(np.repeat(doc_codes, sentence_counts), dtype=doc_id_dtype),
+        "sentence_idx": np.arange(len(begins)) - first_sentences,
         "begin": begins,
         "end": ends,
-        "text": sentences,
-    }).astype({doc_id_col: docs[doc_id_col].dtype})
-    df = df.merge(docs[[doc_id_col] + [col for col in docs.columns if col not in df.columns and col != "text"]])
+    })
+    if include_text:
+        df["text"] = [txt[b:e] for txt, b, e in zip(np.repeat(np.asarray(texts, dtype=object), sentence_counts), begins.tolist(), ends.tolist())]
+    df = df.merge(docs[[doc_id_col] + [col for col in docs.columns if col not in df.columns and col != "text"]].astype({doc_id_col: doc_id_dtype}))
     df["sentence_id"] = join_cols(df[[doc_id_col, "sentence_idx"]], "/")
     return df
 
 
+def regex_sentencize_stream(docs, batch_size=1000, **kwargs):
+    """
+    Same as `regex_sentencize`, but yields the sentences of `batch_size` docs at a time
+    instead of holding the sentences of all the docs in memory
+
+    Parameters
+    ----------
+    docs: pd.DataFrame
+    batch_size: int
+        Number of docs to split per yielded dataframe
+    kwargs:
+        Parameters of `regex_sentencize`, `n_threads` workers are started for each batch
+
+    Returns
+    -------
+    iterator of pd.DataFrame
+    """
+    # All the batches share the categories of the doc ids, so that they can be concatenated
+    doc_ids = docs[kwargs.get("doc_id_col", "doc_id")]
+    doc_id_dtype = doc_ids.dtype if hasattr(doc_ids, 'cat') else pd.CategoricalDtype(pd.unique(doc_ids))
+    for batch_begin in range(0, len(docs), batch_size):
+        yield regex_sentencize(docs.iloc[batch_begin:batch_begin + batch_size], doc_id_dtype=doc_id_dtype, **kwargs)
+
+
 @cached.will_ignore(("n_threads", "with_tqdm"))
-def mimic_sentencize(texts, max_sentence_length=None, min_sentence_length=None, n_threads=1, with_tqdm=False, text_col="text", doc_id_col="doc_id", verbose=0):
+@cached.will_replace_hash({"texts": "docs_hash"})
+def mimic_sentencize(texts, max_sentence_length=None, min_sentence_length=None, n_threads=1, with_tqdm=False, text_col="text", doc_id_col="doc_id", verbose=0,
+                     docs_hash=None, include_text=True):
+    # docs_hash is only used by the cache, to identify the texts without hashing them
     return regex_sentencize(texts, max_sentence_length, min_sentence_length, reg_split=r"(\s*\n\s*\n\s*)", n_threads=n_threads, with_tqdm=with_tqdm, text_col=text_col, doc_id_col=doc_id_col,
-                            verbose=verbose)
+                            include_text=include_text, verbose=verbose)
 
 
 @cached.will_ignore(("n_threads", "with_tqdm"))
-def newline_sentencize(texts, max_sentence_length=None, min_sentence_length=None, n_threads=1, with_tqdm=False, text_col="text", doc_id_col="doc_id", verbose=0):
+@cached.will_replace_hash({"texts": "docs_hash"})
+def newline_sentencize(texts, max_sentence_length=None, min_sentence_length=None, n_threads=1, with_tqdm=False, text_col="text", doc_id_col="doc_id", verbose=0,
+                       docs_hash=None, include_text=True):
+    # docs_hash is only used by the cache, to identify the texts without hashing them
     return regex_sentencize(texts, max_sentence_length, min_sentence_length, reg_split=r"((?:\s*\n){1,}\s*)", n_threads=n_threads, with_tqdm=with_tqdm, text_col=text_col, doc_id_col=doc_id_col,
-                            verbose=verbose)
+                            include_text=include_text, verbose=verbose)
+
+
+def mimic_sentencize_stream(texts, max_sentence_length=None, min_sentence_length=None, batch_size=1000, n_threads=1, with_tqdm=False, text_col="text", doc_id_col="doc_id", verbose=0, include_text=True):
+    return regex_sentencize_stream(texts, batch_size=batch_size, max_sentence_length=max_sentence_length, min_sentence_length=min_sentence_length, reg_split=r"(\s*\n\s*\n\s*)",
+                                   n_threads=n_threads, with_tqdm=with_tqdm, text_col=text_col, doc_id_col=doc_id_col, include_text=include_text, verbose=verbose)
+
+
+def newline_sentencize_stream(texts, max_sentence_length=None, min_sentence_length=None, batch_size=1000, n_threads=1, with_tqdm=False, text_col="text", doc_id_col="doc_id", verbose=0, include_text=True):
+    return regex_sentencize_stream(texts, batch_size=batch_size, max_sentence_length=max_sentence_length, min_sentence_length=min_sentence_length, reg_split=r"((?:\s*\n){1,}\s*)",
+                                   n_threads=n_threads, with_tqdm=with_tqdm, text_col=text_col, doc_id_col=doc_id_col, include_text=include_text, verbose=verbose)
@@ -594,11 +594,24 @@ class cached(object):
 
         return apply_on_func
 
+    @classmethod
+    def will_replace_hash(cls, names):
+        """
+        Hash the value of another argument instead of the argument itself when it is given,
+        ex: {"docs": "docs_hash"} lets the caller pass a precomputed docs_hash to avoid hashing docs
+        """
+        def apply_on_func(func):
+            func._hash_replacements = tuple(names.items())
+            return func
+
+        return apply_on_func
+
     def __init__(self, with_state=False, hash_only=None, ram=False, ignore=None, loader=None, dumper=None, default_cache_mode="rw"):
         self.ready = False
         self.with_state = with_state
         self.cls = None
         self.ignore = ignore
+        self.hash_replacements = ()
         self.hash_only = hash_only
         self.ram = ram
         self.loader = loader
@@ -640,6 +653,11 @@ class cached(object):
             for name in self.ignore:
                 if name in bound_arguments.arguments:
                     del bound_arguments.arguments[name]
+            for name, hash_name in self.hash_replacements:
+                if hash_name in bound_arguments.arguments:
+                    hash_value = bound_arguments.arguments.pop(hash_name)
+                    if hash_value is not None:
+                        bound_arguments.arguments[name] = hash_value
             expect_cache_handle = False
             if '_cache' in sig.parameters:
                 expect_cache_handle = True
@@ -709,7 +727,8 @@ class cached(object):
             func = args[0]
             if self.ignore is None:
                 self.ignore = getattr(func, '_ignore_args', ())
-            cache_key = (func, self.with_state, self.ram, self.ignore, self.loader, self.dumper, self.default_cache_mode)
+            self.hash_replacements = getattr(func, '_hash_replacements', ())
+            cache_key = (func, self.with_state, self.ram, self.ignore, self.hash_replacements, self.loader, self.dumper, self.default_cache_mode)
             if cache_key in cached.MAP:
                 return cached.MAP[cache_key]
             self.cls = get_class_that_defined_method(func)
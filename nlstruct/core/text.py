@@ -1,13 +1,15 @@
 import re
-from functools import reduce
+from concurrent.futures import ProcessPoolExecutor
 from itertools import repeat
 from logging import warn
 import numpy as np
 import pandas as pd
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 from tqdm import tqdm
 from unidecode import unidecode
 
-from nlstruct.core.pandas import make_merged_names_map, merge_with_spans, make_id_from_merged, flatten
+from nlstruct.core.pandas import make_merged_names_map, merge_with_spans
 
 
 def make_tag_scheme(length, entity, scheme='bio'):
@@ -20,11 +22,59 @@ def make_tag_scheme(length, entity, scheme='bio'):
     raise ValueError(f"'{scheme}' scheme is not supported")
 
 
+def make_tag_codes(lengths, label_codes, scheme='bio'):
+    """
+    Same as make_tag_scheme for consecutive spans of `lengths` tokens, each one labelled by its code in `label_codes`,
+    but returns the codes of the tags in the categories ["O", "B-label0", "I-label0", ("L-label0", "U-label0"), "B-label1", ...]
+    The tokens of the spans whose label code is -1 get the -1 (missing) code
+
+    Returns
+    -------
+    np.ndarray
+        int array of the tag codes of all the tokens
+    """
+    if scheme not in ("bio", "bioul"):
+        raise ValueError(f"'{scheme}' scheme is not supported")
+    lengths = np.asarray(lengths, dtype=int)
+    label_codes = np.asarray(label_codes, dtype=int)
+    starts = np.cumsum(lengths) - lengths
+    b_codes = 1 + label_codes * (2 if scheme == "bio" else 4)
+
+    codes = np.repeat(b_codes + 1, lengths)
+    if scheme == "bioul":
+        codes[starts + lengths - 1] = b_codes + 2
+    codes[starts] = b_codes
+    if scheme == "bioul":
+        codes[starts[lengths == 1]] = b_codes[lengths == 1] + 3
+    codes[np.repeat(label_codes < 0, lengths)] = -1
+    return codes
+
+
+def fits_dtype(dtype, *arrays):
+    info = np.iinfo(dtype)
+    return all(len(array) == 0 or (info.min <= array.min() and array.max() <= info.max) for array in arrays)
+
+
 class DeltaCollection(object):
-    def __init__(self, begins, ends, deltas):
-        self.begins = np.asarray(begins, dtype=int)
-        self.ends = np.asarray(ends, dtype=int)
-        self.deltas = np.asarray(deltas, dtype=int)
+    __slots__ = ('begins', 'ends', 'deltas', '_sorted_ends', '_cum_deltas', '_max_ends', '_inverse')
+
+    def __init__(self, begins, ends, deltas, sort=True, dtype=None):
+        begins = np.asarray(begins, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        deltas = np.asarray(deltas, dtype=np.int64)
+        if dtype is None:
+            # Text positions rarely need 64 bits, and the binary searches of apply are faster on smaller ints
+            # for large collections (small ones fit in cache either way and are not worth the range check)
+            dtype = np.int32 if len(begins) >= 1024 and fits_dtype(np.int32, begins, ends, deltas) else np.int64
+        self.begins = begins.astype(dtype, copy=False)
+        self.ends = ends.astype(dtype, copy=False)
+        self.deltas = deltas.astype(dtype, copy=False)
+        # Keep the spans sorted by begin, then end, to look them up with binary searches
+        if sort and np.any((self.begins[1:] < self.begins[:-1]) | ((self.begins[1:] == self.begins[:-1]) & (self.ends[1:] < self.ends[:-1]))):
+            sorter = np.lexsort((self.ends, self.begins))
+            self.begins, self.ends, self.deltas = self.begins[sorter], self.ends[sorter], self.deltas[sorter]
+        # The collection is never modified, so the lookup arrays are computed on first use only
+        self._sorted_ends = self._cum_deltas = self._max_ends = self._inverse = None
 
     @classmethod
     def from_absolute(cls, begins, ends, deltas):
@@ -40,35 +90,55 @@ class DeltaCollection(object):
                                                           ", ".join(map(str, self.deltas)))
 
     def apply(self, positions, side='left'):
+        """
+        Add to each position the deltas of the spans that end before it, and move the positions
+        that fall strictly inside a span to the begin (side='left') or to the shifted end (side='right')
+        of the first such span
+        """
         positions = np.asarray(positions)
-        to_add = ((positions.reshape(-1, 1) >= self.ends.reshape(1, -1)) * self.deltas).sum(axis=1)
-        between = np.logical_and(self.begins.reshape(1, -1) < positions.reshape(-1, 1),
-                                 positions.reshape(-1, 1) < self.ends.reshape(1, -1))
-        between_mask = between.any(axis=1)
-        between = between[between_mask]
-        between_i = between.argmax(axis=1)
+        begins, ends, deltas = self.begins, self.ends, self.deltas
+        # Search the positions with the dtype of the spans, otherwise numpy would upcast the spans at each search,
+        # the shifts are still computed on 64 bits
+        search_positions = positions
+        if positions.dtype != begins.dtype and np.issubdtype(positions.dtype, np.integer) and fits_dtype(begins.dtype, positions):
+            search_positions = positions.astype(begins.dtype)
+        if self._sorted_ends is None:
+            ends_order = np.argsort(ends, kind='stable')
+            self._sorted_ends = ends[ends_order]
+            self._cum_deltas = np.concatenate([[0], np.cumsum(deltas[ends_order], dtype=np.int64)])
+            # When the spans are sorted by begin, those that begin before a position are a prefix of the spans,
+            # and the first of them that ends after the position is found on the running max of their ends
+            if np.all(begins[1:] >= begins[:-1]):
+                self._max_ends = np.maximum.accumulate(ends)
+        to_add = self._cum_deltas[np.searchsorted(self._sorted_ends, search_positions, side='right')]
+        if self._max_ends is not None:
+            n_begun = np.searchsorted(begins, search_positions, side='left')
+            first_not_ended = np.searchsorted(self._max_ends, search_positions, side='right')
+            between_mask = first_not_ended < n_begun
+            between_i = first_not_ended[between_mask]
+        else:
+            # Nested edits can leave the shifted spans unsorted, the positions are then compared to every span,
+            # by blocks of positions to bound the size of the comparison matrix
+            between_i = np.full(len(positions), -1)
+            block_size = max(1, (1 << 22) // len(begins))
+            for block_begin in range(0, len(positions), block_size):
+                block = search_positions[block_begin:block_begin + block_size].reshape(-1, 1)
+                between = np.logical_and(begins.reshape(1, -1) < block, block < ends.reshape(1, -1))
+                between_i[block_begin:block_begin + block_size] = np.where(between.any(axis=1), between.argmax(axis=1), -1)
+            between_mask = between_i >= 0
+            between_i = between_i[between_mask]
         if side == 'right':
-            to_add[between_mask] += self.ends[between_i] - positions[between_mask] + self.deltas[between_i]
+            to_add[between_mask] += ends[between_i] - positions[between_mask] + deltas[between_i]
         elif side == 'left':
-            to_add[between_mask] += self.begins[between_i] - positions[between_mask]
+            to_add[between_mask] += begins[between_i] - positions[between_mask]
         return positions + to_add
 
     def unapply(self, positions, side='left'):
-        positions = np.asarray(positions)
-        begins = self.apply(self.begins, side='left')
-        ends = self.apply(self.ends, side='right')
-        to_remove = -((positions.reshape(-1, 1) >= ends.reshape(1, -1)) * self.deltas).sum(axis=1)
-        between = np.logical_and(begins.reshape(1, -1) < positions.reshape(-1, 1),
-                                 positions.reshape(-1, 1) < ends.reshape(1, -1))
-        between_mask = between.any(axis=1)
-        between = between[between_mask]
-        between_i = between.argmax(axis=1)
-        if side == 'right':
-            to_remove[between_mask] += ends[between_i] - positions[between_mask] - self.deltas[between_i]
-        elif side == 'left':
-            to_remove[between_mask] += begins[between_i] - positions[between_mask]
-        pos = positions + to_remove
-        return pos
+        # The reverse edits span the edited texts, and must not be reordered since the first
+        # span that contains a position decides where it is moved
+        if self._inverse is None:
+            self._inverse = DeltaCollection(self.apply(self.begins, side='left'), self.apply(self.ends, side='right'), -self.deltas, sort=False)
+        return self._inverse.apply(positions, side=side)
 
     def __add__(self, other):
         if len(self.begins) == 0:
@@ -77,11 +147,11 @@ class DeltaCollection(object):
             return self
         begins = self.unapply(other.begins, side='left')
         ends = self.unapply(other.ends, side='right')
-        new_begins = np.concatenate([begins, self.begins])
-        new_ends = np.concatenate([ends, self.ends])
-        new_deltas = np.concatenate([other.deltas, self.deltas])
-        sorter = np.lexsort((new_ends, new_begins))
-        return DeltaCollection(new_begins[sorter], new_ends[sorter], new_deltas[sorter])
+        # Both sides are sorted, the collection merges them with a single stable sort
+        # that keeps the spans of other first on ties
+        return DeltaCollection(np.concatenate([begins, self.begins]),
+                               np.concatenate([ends, self.ends]),
+                               np.concatenate([other.deltas, self.deltas]))
 
 
 def make_str_from_groups(replacement, groups):
@@ -90,27 +160,47 @@ def make_str_from_groups(replacement, groups):
     return replacement
 
 
-def regex_sub_with_spans(pattern, replacement, text):
-    needed_groups = [int(i) for i in re.findall(r"\\([0-9]+)", replacement)]
-    begins = []
-    ends = []
-    deltas = []
-    for match in reversed(list(re.finditer(pattern, text))):
-        middle = make_str_from_groups(replacement, [match.group(i) for i in needed_groups])
-        start = match.start()
-        end = match.end()
-        text = text[:start] + middle + text[end:]
-        begins.append(start)
-        ends.append(end)
-        deltas.append(len(middle) - end + start)
-    return text, DeltaCollection(begins, ends, deltas)
+def compile_pattern(pattern):
+    # Patterns can also be given already compiled, by re or by another engine with the same api (re2, regex, ...)
+    return re.compile(pattern) if isinstance(pattern, str) else pattern
+
+
+def get_needed_groups(replacement):
+    if "\\" not in replacement:
+        return []
+    return [int(i) for i in re.findall(r"\\([0-9]+)", replacement)]
+
+
+def regex_sub_with_spans(pattern, replacement, text, needed_groups=None):
+    if needed_groups is None:
+        needed_groups = get_needed_groups(replacement)
+    matches = list(compile_pattern(pattern).finditer(text))
+    begins = [match.start() for match in matches]
+    ends = [match.end() for match in matches]
+    kept = [text[end:begin] for end, begin in zip([0, *ends], [*begins, len(text)])]
+    begins = np.asarray(begins, dtype=int)
+    ends = np.asarray(ends, dtype=int)
+    if needed_groups:
+        middles = [make_str_from_groups(replacement, [match.group(i) for i in needed_groups]) for match in matches]
+        pieces = [None] * (len(kept) + len(middles))
+        pieces[::2] = kept
+        pieces[1::2] = middles
+        text = "".join(pieces)
+        middle_lengths = np.fromiter(map(len, middles), dtype=int, count=len(middles))
+    else:
+        # Without backreferences, every match is replaced by the same string
+        text = replacement.join(kept)
+        middle_lengths = len(replacement)
+    return text, DeltaCollection(begins, ends, middle_lengths - ends + begins)
 
 
-def regex_multisub_with_spans(patterns, replacements, text, deltas=None):
+def regex_multisub_with_spans(patterns, replacements, text, deltas=None, needed_groups=None):
     if deltas is None:
         deltas = DeltaCollection([], [], [])
-    for pattern, replacement in zip(patterns, replacements):
-        text, new_deltas = regex_sub_with_spans(pattern, replacement, text)
+    if needed_groups is None:
+        needed_groups = [get_needed_groups(replacement) for replacement in replacements]
+    for pattern, replacement, pattern_needed_groups in zip(patterns, replacements, needed_groups):
+        text, new_deltas = regex_sub_with_spans(pattern, replacement, text, needed_groups=pattern_needed_groups)
         if deltas is not None:
             deltas += new_deltas
         else:
@@ -119,71 +209,145 @@ def regex_multisub_with_spans(patterns, replacements, text, deltas=None):
 
 
 def run_unidecode(text):
-    begins, ends, deltas = [], [], []
-    new_text = ""
-    for i, (old_char, new_char) in enumerate((char, unidecode(char)) for char in text):
-        if len(old_char) != len(new_char):
-            begins.append(i)
-            ends.append(i+1)
-            deltas.append(len(new_char)-1)
-        new_text += new_char
-    return new_text, DeltaCollection(begins, ends, deltas)
+    # Only non ascii chars can be changed by unidecode, each distinct one is transliterated once
+    codepoints = np.frombuffer(text.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+    non_ascii = np.flatnonzero(codepoints >= 128)
+    unique_codepoints, inverse = np.unique(codepoints[non_ascii], return_inverse=True)
+    new_chars = [unidecode(chr(codepoint)) for codepoint in unique_codepoints.tolist()]
+    deltas = np.fromiter(map(len, new_chars), dtype=int, count=len(new_chars))[inverse] - 1
+    changed = deltas != 0
+    new_text = text.translate(dict(zip(unique_codepoints.tolist(), new_chars))) if len(new_chars) else text
+    return new_text, DeltaCollection(non_ascii[changed], non_ascii[changed] + 1, deltas[changed])
+
+
+def transform_text_batch(texts, docs_patterns, docs_replacements, docs_needed_groups, apply_unidecode=False):
+    """
+    Transform a batch of texts and compose their deltas all at once instead of one text at a time:
+    the original texts are laid out one after the other in a single coordinate system, far enough from each
+    other for the deltas of a text to never act on the positions of another (composed nested edits can leave
+    positions a bit outside of the bounds of their text), and each text then starts further by the growth
+    of the texts before it
+
+    Returns
+    -------
+    list of (str, np.ndarray, np.ndarray, np.ndarray)
+        new text, begins, ends and deltas of each text
+    """
+    texts = list(texts)
+    lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+    offsets = np.arange(len(texts), dtype=np.int64) << 32
+    deltas = DeltaCollection([], [], [])
+    if apply_unidecode:
+        # Unidecode only changes non ascii chars, the texts can be joined by a char that it leaves as is
+        joined_offsets = np.cumsum(lengths + 1) - lengths - 1
+        text, joined_deltas = run_unidecode("\0".join(texts))
+        texts = [text[begin:end] for begin, end in zip(joined_deltas.apply(joined_offsets).tolist(),
+                                                         joined_deltas.apply(joined_offsets + lengths).tolist())]
+        shift = offsets - joined_offsets
+        doc_idx = np.searchsorted(joined_offsets, joined_deltas.begins, side='right') - 1
+        deltas = DeltaCollection(joined_deltas.begins + shift[doc_idx], joined_deltas.ends + shift[doc_idx], joined_deltas.deltas)
+    for step in range(max(map(len, docs_patterns), default=0)):
+        growth = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts)) - lengths
+        starts = (offsets + np.cumsum(growth) - growth).tolist()
+        begins, ends, values = [], [], []
+        for i, (patterns, replacements, needed_groups) in enumerate(zip(docs_patterns, docs_replacements, docs_needed_groups)):
+            if step < len(patterns):
+                texts[i], text_deltas = regex_sub_with_spans(patterns[step], replacements[step], texts[i], needed_groups=needed_groups[step])
+                begins.append(text_deltas.begins.astype(np.int64) + starts[i])
+                ends.append(text_deltas.ends.astype(np.int64) + starts[i])
+                values.append(text_deltas.deltas)
+        deltas += DeltaCollection(np.concatenate(begins), np.concatenate(ends), np.concatenate(values))
+    # The composed deltas are sorted and their spans are on the original texts, cut them between the texts
+    bounds = np.searchsorted(deltas.begins, offsets - (1 << 31), side='left').tolist() + [len(deltas.begins)]
+    delta_begins, delta_ends, delta_values = (array.astype(np.int64, copy=False) for array in (deltas.begins, deltas.ends, deltas.deltas))
+    return [(text,
+             delta_begins[begin:end] - offset,
+             delta_ends[begin:end] - offset,
+             delta_values[begin:end])
+            for text, begin, end, offset in zip(texts, bounds[:-1], bounds[1:], offsets.tolist())]
+
+
+def process_texts(texts, docs_patterns, docs_replacements, global_patterns, global_replacements,
+                  apply_unidecode=False, return_deltas=True, with_tqdm=False, batch_size=4096):
+    # The global patterns are the same for every doc, compile them and parse their replacements once
+    global_patterns = [compile_pattern(pattern) for pattern in global_patterns]
+    global_needed_groups = [get_needed_groups(replacement) for replacement in global_replacements]
+    results = []
+    if return_deltas:
+        # Consecutive docs are transformed together, by batches of about batch_size chars
+        lengths = np.fromiter(map(len, texts), dtype=int, count=len(texts))
+        batch_ids = np.cumsum(lengths) // batch_size
+        bounds = [0, *(np.flatnonzero(np.diff(batch_ids)) + 1).tolist(), len(texts)] if len(texts) else [0]
+        with tqdm(total=len(texts), disable=not with_tqdm) as bar:
+            for begin, end in zip(bounds[:-1], bounds[1:]):
+                results.extend(transform_text_batch(
+                    texts[begin:end],
+                    [[*doc_patterns, *global_patterns] for doc_patterns in docs_patterns[begin:end]],
+                    [[*doc_replacements, *global_replacements] for doc_replacements in docs_replacements[begin:end]],
+                    [[*(get_needed_groups(replacement) for replacement in doc_replacements), *global_needed_groups]
+                     for doc_replacements in docs_replacements[begin:end]],
+                    apply_unidecode=apply_unidecode,
+                ))
+                bar.update(end - begin)
+        return results
+    for text, doc_patterns, doc_replacements in tqdm(zip(texts, docs_patterns, docs_replacements), total=len(texts), disable=not with_tqdm):
+        if apply_unidecode:
+            text = unidecode(text)
+        for pattern, replacement in zip([*doc_patterns, *global_patterns], [*doc_replacements, *global_replacements]):
+            text = compile_pattern(pattern).sub(replacement, text)
+        results.append(text)
+    return results
 
 
 def transform_text(dataset,
                    global_patterns=None,
                    global_replacements=None,
                    apply_unidecode=False,
-                   return_deltas=True, with_tqdm=False):
+                   return_deltas=True, with_tqdm=False, n_threads=1):
     assert (global_patterns is None) == (global_replacements is None)
     if global_patterns is None:
         global_patterns = []
         global_replacements = []
 
-    def process_text(text, doc_patterns, doc_replacements):
-        deltas = None
-        if apply_unidecode:
-            text, deltas = run_unidecode(text)
-        text, deltas = regex_multisub_with_spans(
-            [*doc_patterns, *global_patterns],
-            [*doc_replacements, *global_replacements],
-            text,
-            deltas=deltas,
-        )
-        return text, deltas.begins, deltas.ends, deltas.deltas
+    texts = dataset["text"].tolist()
+    docs_patterns = dataset["patterns"].tolist() if "patterns" in dataset.columns else [[]] * len(texts)
+    docs_replacements = dataset["replacements"].tolist() if "replacements" in dataset.columns else [[]] * len(texts)
+    n_threads = min(n_threads, len(texts))
+    if n_threads > 1:
+        # Docs are transformed independently, each worker gets a contiguous chunk of them
+        bounds = np.linspace(0, len(texts), n_threads + 1).astype(int).tolist()
+        chunks = [slice(begin, end) for begin, end in zip(bounds[:-1], bounds[1:])]
+        with ProcessPoolExecutor(max_workers=n_threads) as executor:
+            results = [result
+                       for chunk_results in executor.map(
+                           process_texts,
+                           [texts[chunk] for chunk in chunks],
+                           [docs_patterns[chunk] for chunk in chunks],
+                           [docs_replacements[chunk] for chunk in chunks],
+                           repeat(global_patterns), repeat(global_replacements), repeat(apply_unidecode), repeat(return_deltas))
+                       for result in chunk_results]
+    else:
+        results = process_texts(texts, docs_patterns, docs_replacements, global_patterns, global_replacements,
+                                apply_unidecode=apply_unidecode, return_deltas=return_deltas, with_tqdm=with_tqdm)
 
     if return_deltas:
-        text, delta_begins, delta_ends, deltas = zip(*[
-            process_text(text, doc_patterns, doc_replacements) for text, doc_patterns, doc_replacements in
-            tqdm(zip(
-                dataset["text"],
-                dataset["patterns"] if "patterns" in dataset.columns else repeat([]),
-                dataset["replacements"] if "replacements" in dataset.columns else repeat([])), total=len(dataset), disable=not with_tqdm)
-        ])
-        dataset = pd.DataFrame({
-            "text": text,
-            "begin": delta_begins,
-            "end": delta_ends,
-            "delta": deltas,
-            **{c: dataset[c] for c in dataset.columns if c not in ("text", "begin", "end", "delta")}
+        text, delta_begins, delta_ends, deltas = zip(*results)
+        # The deltas of all the docs are concatenated at once instead of flattening one row per doc
+        delta_counts = np.fromiter(map(len, deltas), dtype=int, count=len(deltas))
+        flat_deltas = pd.DataFrame({
+            "doc_id": dataset["doc_id"].repeat(delta_counts).reset_index(drop=True),
+            "begin": np.concatenate(delta_begins),
+            "end": np.concatenate(delta_ends),
+            "delta": np.concatenate(deltas),
         })
-        return (
-            dataset[[c for c in dataset.columns if c not in ("begin", "end", "delta")]],
-            flatten(dataset[["doc_id", "begin", "end", "delta"]]))
     else:
-        new_texts = []
-        for text, doc_patterns, doc_replacements in tqdm(zip(
-              dataset["text"],
-              dataset["patterns"] if "patterns" in dataset.columns else repeat([]),
-              dataset["replacements"] if "replacements" in dataset.columns else repeat([])), total=len(dataset), disable=not with_tqdm):
-            if apply_unidecode:
-                text = unidecode(text)
-            for pattern, replacement in zip([*doc_patterns, *global_patterns], [*doc_replacements, *global_replacements]):
-                text = re.sub(pattern, replacement, text)
-            new_texts.append(text)
-        dataset = pd.DataFrame({"text": new_texts,
-                                **{c: dataset[c] for c in dataset.columns if c not in ("text",)}})
-        return dataset[[c for c in dataset.columns if c not in ("begin", "end", "delta")]]
+        text = results
+    # Only the text column is replaced, the other columns are kept as they are, after the new text
+    dataset = dataset.drop(columns=[c for c in ("text", "begin", "end", "delta") if c in dataset.columns])
+    dataset.insert(0, "text", text)
+    if return_deltas:
+        return dataset, flat_deltas
+    return dataset
 
 
 def apply_deltas(positions, deltas, on, position_columns=None):
@@ -204,30 +368,78 @@ def apply_deltas(positions, deltas, on, position_columns=None):
 
     delta_col_map, positions_col_map = make_merged_names_map(deltas.columns, [*position_columns, *on, '_id_col'],
                                                              left_on=on, right_on=on, suffixes=('_delta', '_pos'))
+    delta_begins = mention_deltas[delta_col_map['begin']].to_numpy()
+    delta_ends = mention_deltas[delta_col_map['end']].to_numpy()
+    delta_values = mention_deltas[delta_col_map['delta']].to_numpy()
     for col, side in position_columns.items():
-        mention_deltas.eval(f"shift = ({delta_col_map['end']} <= {positions_col_map[col]}) * {delta_col_map['delta']}",
-                            inplace=True)
-        mention_deltas.eval(
-            f"between_magnet = {delta_col_map['begin']} < {positions_col_map[col]} and {positions_col_map[col]} < {delta_col_map['end']}",
-            inplace=True)
+        position_values = mention_deltas[positions_col_map[col]].to_numpy()
+        mention_deltas["shift"] = (delta_ends <= position_values) * delta_values
+        between_magnet = (delta_begins < position_values) & (position_values < delta_ends)
         if side == "left":
-            mention_deltas.eval(
-                f"between_magnet = between_magnet * ({delta_col_map['begin']} - {positions_col_map[col]})",
-                inplace=True)
+            between_magnet = between_magnet * (delta_begins - position_values)
         elif side == "right":
-            mention_deltas.eval(
-                f"between_magnet = between_magnet * ({delta_col_map['end']} + {delta_col_map['delta']} - {positions_col_map[col]})",
-                inplace=True)
+            between_magnet = between_magnet * (delta_ends + delta_values - position_values)
+        mention_deltas["between_magnet"] = between_magnet
+        # Only the magnet of the first (left) / last (right) delta of each position is kept
         order = "first" if side == "left" else "last"
-        tmp = mention_deltas.sort_values(['_id_col', delta_col_map['begin' if side == 'left' else 'end']]).groupby(
-            '_id_col').agg({
-            "shift": "sum",
-            **{n: order for n in mention_deltas.columns if n not in ("shift", "_id_col")}})
-        positions[col] = positions[col].add(tmp['shift'] + tmp['between_magnet'], fill_value=0)
+        magnets = mention_deltas['between_magnet'].iloc[np.lexsort((mention_deltas[delta_col_map['begin' if side == 'left' else 'end']].to_numpy(),
+                                                                    mention_deltas.index.to_numpy()))]
+        magnets = magnets[~magnets.index.duplicated(keep=order)]
+        shifts = mention_deltas['shift'].groupby(level='_id_col').sum()
+        positions[col] = positions[col].add(shifts + magnets, fill_value=0)
     positions = positions.reset_index(drop=True)
     return positions
 
 
+def shift_deltas(deltas, on):
+    """
+    Same as apply_deltas(deltas, deltas, on), without merging each delta with all the deltas of its doc:
+    the deltas of each doc are sorted once and the shifts of their own begins and ends are found by binary search
+
+    Parameters
+    ----------
+    deltas: pd.DataFrame[begin, end, delta, ...]
+    on: list of str
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    deltas = deltas.reset_index(drop=True)
+    if len(deltas) == 0:
+        return deltas
+    doc_ids = deltas.groupby(on, observed=True, sort=False, dropna=False).ngroup().to_numpy()
+    begins = deltas['begin'].to_numpy()
+    ends = deltas['end'].to_numpy()
+    values = deltas['delta'].to_numpy()
+
+    # (doc, end) pairs packed in single integers to search the deltas that end before a position in its doc
+    min_pos = min(begins.min(), ends.min())
+    n_pos = max(begins.max(), ends.max()) - min_pos + 1
+    ends_order = np.lexsort((ends, doc_ids))
+    sorted_keys = doc_ids[ends_order] * n_pos + ends[ends_order] - min_pos
+    cum_deltas = np.concatenate([[0], np.cumsum(values[ends_order])])
+    doc_starts = np.flatnonzero(np.diff(doc_ids[ends_order], prepend=-1))
+    # Like in apply_deltas, only the first delta (by begin) of each doc can move a begin inside it,
+    # and only the last delta (by end) of each doc can move an end inside it
+    magnet_rows = {'left': np.lexsort((begins, doc_ids))[doc_starts],
+                   'right': ends_order[np.append(doc_starts[1:], len(deltas)) - 1]}
+
+    shifted = {}
+    for col, side in (('begin', 'left'), ('end', 'right')):
+        positions = deltas[col].to_numpy()
+        shift = (cum_deltas[np.searchsorted(sorted_keys, doc_ids * n_pos + positions - min_pos, side='right')]
+                 - cum_deltas[doc_starts[doc_ids]])
+        magnet = magnet_rows[side][doc_ids]
+        between = (begins[magnet] < positions) & (positions < ends[magnet])
+        if side == "left":
+            shift += between * (begins[magnet] - positions)
+        else:
+            shift += between * (ends[magnet] + values[magnet] - positions)
+        shifted[col] = positions + shift
+    return deltas.assign(**shifted)
+
+
 def reverse_deltas(positions, deltas, on, position_columns=None):
     if not isinstance(on, (tuple, list)):
         on = [on]
@@ -237,7 +449,7 @@ def reverse_deltas(positions, deltas, on, position_columns=None):
     positions = positions.copy()
     positions['_id_col'] = np.arange(len(positions))
 
-    deltas = apply_deltas(deltas, deltas, on, position_columns={'begin': 'left', 'end': 'right'})
+    deltas = shift_deltas(deltas, on)
     mention_deltas = merge_with_spans(positions[[*position_columns, *on, '_id_col']], deltas, on=on,
                                       suffixes=('_pos', '_delta'), how='left')
 
@@ -248,29 +460,25 @@ def reverse_deltas(positions, deltas, on, position_columns=None):
     # mention_deltas = mention_deltas[[c for c in mention_deltas.columns if c not in on]]
     delta_col_map, positions_col_map = make_merged_names_map(deltas.columns, [*position_columns, *on, '_id_col'],
                                                              left_on=on, right_on=on, suffixes=('_delta', '_pos'))
+    delta_begins = mention_deltas[delta_col_map['begin']].to_numpy()
+    delta_ends = mention_deltas[delta_col_map['end']].to_numpy()
+    delta_values = mention_deltas[delta_col_map['delta']].to_numpy()
     for col, side in position_columns.items():
-        mention_deltas.eval(
-            f"shift = ({delta_col_map['end']} <= {positions_col_map[col]}) * (-{delta_col_map['delta']})",
-            inplace=True)
-        mention_deltas.eval(
-            f"between_magnet = {delta_col_map['begin']} < {positions_col_map[col]} and {positions_col_map[col]} < {delta_col_map['end']}",
-            inplace=True)
+        position_values = mention_deltas[positions_col_map[col]].to_numpy()
+        mention_deltas["shift"] = (delta_ends <= position_values) * (-delta_values)
+        between_magnet = (delta_begins < position_values) & (position_values < delta_ends)
         if side == "left":
-            mention_deltas.eval(
-                f"between_magnet = between_magnet * ({delta_col_map['begin']} - {positions_col_map[col]})",
-                inplace=True)
+            between_magnet = between_magnet * (delta_begins - position_values)
         elif side == "right":
-            mention_deltas.eval(
-                f"between_magnet = between_magnet * ({delta_col_map['end']} - {delta_col_map['delta']} - {positions_col_map[col]})",
-                inplace=True)
+            between_magnet = between_magnet * (delta_ends - delta_values - position_values)
+        mention_deltas["between_magnet"] = between_magnet
+        # Only the magnet of the first (left) / last (right) delta of each position is kept
         order = "first" if side == "left" else "last"
-
-        tmp = mention_deltas.sort_values(['_id_col', delta_col_map['begin' if side == 'left' else 'end']])
-
-        tmp = tmp.groupby('_id_col').agg({
-            "shift": "sum",
-            **{n: order for n in mention_deltas.columns if n not in ("shift", "_id_col")}})
-        positions[col] = positions[col].add(tmp['shift'] + tmp['between_magnet'], fill_value=0).astype(int)
+        magnets = mention_deltas['between_magnet'].iloc[np.lexsort((mention_deltas[delta_col_map['begin' if side == 'left' else 'end']].to_numpy(),
+                                                                    mention_deltas.index.to_numpy()))]
+        magnets = magnets[~magnets.index.duplicated(keep=order)]
+        shifts = mention_deltas['shift'].groupby(level='_id_col').sum()
+        positions[col] = positions[col].add(shifts + magnets, fill_value=0).astype(int)
     positions = positions.reset_index(drop=True)
     return positions
 
@@ -290,6 +498,35 @@ def preprocess_ids(large, small, large_id_cols=None, small_id_cols=None):
         [c for c in large.columns if c not in large_id_cols and c not in ("begin", "end") and c not in doc_id_cols])
 
 
+def find_tokens_in_spans(large, small, doc_id_cols):
+    """
+    Find the (large, small) pairs of rows of the same doc such that the small "token_idx" is in the large [begin, end) span,
+    by binary search of the spans bounds in the token indices sorted by doc
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray)
+        positional indices of the large and small rows of each pair, in the order of the large rows
+    """
+    doc_ids = (pd.concat([large[doc_id_cols], small[doc_id_cols]], ignore_index=True)
+               .groupby(doc_id_cols, observed=True, sort=False, dropna=False).ngroup().to_numpy())
+    large_docs, small_docs = doc_ids[:len(large)], doc_ids[len(large):]
+    token_idx = small["token_idx"].to_numpy()
+    if len(large) == 0 or len(small) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+    # (doc, token_idx) pairs packed in single integers, the span bounds are clipped to the range of the token indices
+    min_idx = token_idx.min()
+    n_idx = token_idx.max() - min_idx + 2
+    tokens_order = np.lexsort((token_idx, small_docs))
+    sorted_keys = small_docs[tokens_order] * n_idx + token_idx[tokens_order] - min_idx
+    lo, hi = (np.searchsorted(sorted_keys, large_docs * n_idx + np.clip(large[col].to_numpy(), min_idx, min_idx + n_idx - 1) - min_idx, side='left')
+              for col in ("begin", "end"))
+    counts = np.maximum(hi - lo, 0)
+    starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+    return np.repeat(np.arange(len(large)), counts), tokens_order[starts + np.arange(counts.sum())]
+
+
 def encode_as_tag(small, large, label_cols=None, tag_names=None, tag_scheme="bio", use_token_idx=False, verbose=0, groupby=None):
     """
 
@@ -331,8 +568,9 @@ def encode_as_tag(small, large, label_cols=None, tag_names=None, tag_scheme="bio
         assert label not in large_val_cols, f"Cannot groupby {label} value because there is already a column with this name"
         group_tag_names = ["/".join(s for s in (label, tag_name) if s is not None) for tag_name in tag_names]
         if use_token_idx:
-            merged = merge_with_spans(mentions_of_group, small[[*doc_id_cols, *small_id_cols, *(c for c in small_val_cols if c != "token_idx"), "token_idx"]], on=doc_id_cols, suffixes=('_large', '')).query(
-                "begin <= token_idx and token_idx < end")
+            large_rows, small_rows = find_tokens_in_spans(mentions_of_group, small, doc_id_cols)
+            merged = pd.concat([small[doc_id_cols + small_id_cols].iloc[small_rows].reset_index(drop=True),
+                                mentions_of_group[large_id_cols + label_cols].iloc[large_rows].reset_index(drop=True)], axis=1)
         else:
             merged = merge_with_spans(mentions_of_group, small, span_policy='partial_strict', on=[*doc_id_cols, ("begin", "end")], suffixes=('_large', ''))
 
@@ -346,39 +584,62 @@ def encode_as_tag(small, large, label_cols=None, tag_names=None, tag_scheme="bio
         # Encode mention labels as a tag
         tags = (merged[merged_id_cols + label_cols]
                 .sort_values(merged_id_cols))
-        if tag_scheme != "raw":
-            keep_cols = list(set(doc_id_cols + large_id_cols) - set(label_cols))
-            tags = (
-                # convert all categorical dtypes of group cols as simple types (np.str, np.int, np.object...)
-                # to accelerate concatenation inside the groupby
-                tags.astype({k: dtype if not hasattr(dtype, 'categories') else dtype.categories.dtype for k, dtype in tags.dtypes[keep_cols].items()})
-                    .rename(dict(zip(label_cols, group_tag_names)), axis=1)
-                    .nlstruct.groupby_assign(
-                    doc_id_cols + large_id_cols,
-                    {tag_name: lambda labels: make_tag_scheme(len(labels), labels.iloc[0], tag_scheme)
-                     for tag_name, label_col in zip(group_tag_names, label_cols)})
-                    # convert back each group column dtype to its origial categorical dtype
-                    .astype(tags.dtypes[keep_cols])[doc_id_cols + small_id_cols + group_tag_names]
-            )
-
-        # merged = merged[[*merged_id_cols, *small_val_cols, "begin", "end"]].merge(tags)
-        small = small.merge(tags, on=doc_id_cols + small_id_cols, how="left")
         if tag_scheme != "raw":
             try:
+                tag_dtypes = {}
                 for tag_name, label_col in zip(group_tag_names, label_cols):
                     unique_labels = sorted(set(label for label in mentions_of_group[label_col] if label is not None))\
                         if not hasattr(mentions_of_group[label_col], 'cat') else mentions_of_group[label_col].cat.categories
                     label_categories[tag_name] = unique_labels
-                    small[tag_name] = small[tag_name].fillna("O").astype(pd.CategoricalDtype(
+                    tag_dtypes[tag_name] = pd.CategoricalDtype(
                         ["O", *(tag for label in unique_labels for tag in ("B-" + str(label), "I-" + str(label)))] if tag_scheme == "bio" else
                         ["O", *(tag for label in unique_labels for tag in ("B-" + str(label), "I-" + str(label), "L-" + str(label), "U-" + str(label)))]
-                    ))
+                    )
             except Exception:
                 raise Exception(f"Error occured during the encoding of label column '{label_col}' into tag '{tag_name}'")
+
+            # Tokens of a mention are consecutive once sorted, tag each run of tokens as a whole
+            group_ids = tags.groupby(doc_id_cols + large_id_cols, observed=True, sort=False).ngroup().to_numpy()
+            has_group = group_ids >= 0
+            starts = np.flatnonzero(np.diff(group_ids[has_group], prepend=-1) != 0)
+            lengths = np.diff(starts, append=has_group.sum())
+            tag_codes = {}
+            for tag_name, label_col in zip(group_tag_names, label_cols):
+                entities = tags[label_col].to_numpy()[has_group][starts]
+                # Tokens without mention or with a None label are tagged as "O", labels outside
+                # of the categories are left missing
+                codes = make_tag_codes(lengths, pd.Index(label_categories[tag_name]).get_indexer(entities), tag_scheme)
+                codes[np.repeat(np.asarray([entity is None for entity in entities], dtype=bool), lengths)] = 0
+                tag_codes[tag_name] = np.zeros(len(tags), dtype=int)
+                tag_codes[tag_name][has_group] = codes
+            tags = tags[doc_id_cols + small_id_cols].assign(**tag_codes)
+
+        # merged = merged[[*merged_id_cols, *small_val_cols, "begin", "end"]].merge(tags)
+        small = small.merge(tags, on=doc_id_cols + small_id_cols, how="left")
+        if tag_scheme != "raw":
+            for tag_name in group_tag_names:
+                small[tag_name] = pd.Categorical.from_codes(small[tag_name].fillna(0).astype(int), dtype=tag_dtypes[tag_name])
     # return small[doc_id_cols + small_id_cols].merge(merged, how='left')
     return small, label_categories
 
 
+def format_ids(ids):
+    """
+    Format non negative integer ids as zero padded strings of the width of the largest one,
+    so that they sort like the integers
+
+    Returns
+    -------
+    np.ndarray
+        object array of the formatted ids
+    """
+    ids = np.asarray(ids, dtype=int)
+    max_id = ids.max() if len(ids) else 0
+    # Ids are numbered within each doc and are small, format each possible id only once
+    labels = np.asarray([f"{i:0{len(str(max_id))}d}" for i in range(max_id + 1)], dtype=object)
+    return labels[ids]
+
+
 def partition_spans(smalls, large,
                     overlap_policy="merge_large",
                     new_id_name="sample_id", span_policy="partial_strict"):
@@ -436,27 +697,32 @@ def partition_spans(smalls, large,
         for small in smalls:
             doc_id_cols, small_id_cols, large_id_cols, small_val_cols, large_val_cols = preprocess_ids(large, small)
             large_id_cols = [c for c in large_id_cols]
-            # Merge sentences and mentions
-            merged = merge_with_spans(small, large, span_policy=span_policy, how='right', on=[*doc_id_cols, ("begin", "end")])
-            # If a mention overlap multiple sentences, assign it to the last sentence
-            small_ids = merged[doc_id_cols + small_id_cols].nlstruct.factorize(group_nans=False)
+            # Identify the spans before merging them, there are fewer of them than rows in the merge
+            small_ids = small[doc_id_cols + small_id_cols].nlstruct.factorize(group_nans=False)
             if has_created_new_id_col:
-                large_ids = merged[doc_id_cols + [new_id_name]].nlstruct.factorize(group_nans=False)
+                large_ids = large[doc_id_cols + [new_id_name]].nlstruct.factorize(group_nans=False)
             else:
-                large_ids = merged[doc_id_cols + large_id_cols].nlstruct.factorize(group_nans=False)
-            merged[new_id_name] = make_id_from_merged(
-                large_ids,
-                small_ids,
-                apply_on=[(0, large_ids)])[0]
-            merged["begin"] = merged[['begin_x', 'begin_y']].min(axis=1)
-            merged["end"] = merged[['end_x', 'end_y']].max(axis=1)
+                large_ids = large[doc_id_cols + large_id_cols].nlstruct.factorize(group_nans=False)
+            # Merge sentences and mentions
+            merged = merge_with_spans(small.assign(_small_node=small_ids.to_numpy()), large.assign(_large_node=large_ids.to_numpy()),
+                                      span_policy=span_policy, how='right', on=[*doc_id_cols, ("begin", "end")])
+            # If a mention overlap multiple sentences, merge these sentences: they are connected through the mention
+            large_nodes = merged["_large_node"].to_numpy()
+            has_small = merged["_small_node"].notna().to_numpy()
+            n_nodes = len(large) + len(small)
+            _, components = connected_components(csr_matrix((
+                np.ones(has_small.sum()),
+                (large_nodes[has_small], merged["_small_node"].to_numpy()[has_small].astype(int) + len(large))), shape=(n_nodes, n_nodes)))
+            merged[new_id_name] = pd.factorize(components[large_nodes])[0]
+            merged["begin"] = np.fmin(merged['begin_x'].to_numpy(), merged['begin_y'].to_numpy())
+            merged["end"] = np.fmax(merged['end_x'].to_numpy(), merged['end_y'].to_numpy())
             large = (merged
                      .groupby(new_id_name, as_index=False, observed=True)
                      .agg({**{n: 'first' for n in [*doc_id_cols, *large_id_cols] if n != new_id_name}, 'begin': 'min', 'end': 'max'})
                      .astype({"begin": int, "end": int, **large[doc_id_cols].dtypes}))
-            large = large[doc_id_cols + [new_id_name] + ["begin", "end"]]
-            large[new_id_name] = large['begin']
-            large = large.nlstruct.groupby_assign(doc_id_cols, {new_id_name: lambda x: tuple(np.argsort(np.argsort(x)))})
+            # Number the merged spans by begin within each doc
+            large = large[doc_id_cols + ["begin", "end"]].assign(**{
+                new_id_name: large.groupby(doc_id_cols, observed=True, sort=False)['begin'].rank(method='first').astype(int).to_numpy() - 1})
             old_to_new = large[doc_id_cols + [new_id_name]].drop_duplicates().reset_index(drop=True)
             merged_id_cols = [new_id_name]
         # large[original_new_id_name] = large[doc_id_cols + [new_id_name]].apply(lambda x: "/".join(map(str, x[doc_id_cols])) + "/" + str(x[new_id_name]), axis=1).astype("category")
@@ -483,14 +749,13 @@ def partition_spans(smalls, large,
         elif overlap_policy == "small_to_rightmost_large":
             merged = merged.sort_values([*doc_id_cols, *small_id_cols, 'begin_y']).drop_duplicates([*doc_id_cols, *small_id_cols], keep="last")
         elif overlap_policy == "split_small":
-            merged = merged.assign(begin_x=np.maximum(merged['begin_x'], merged['begin_y']),
-                                   end_x=np.minimum(merged['end_x'], merged['end_y']))
+            merged = merged.assign(begin_x=np.maximum(merged['begin_x'].to_numpy(), merged['begin_y'].to_numpy()),
+                                   end_x=np.minimum(merged['end_x'].to_numpy(), merged['end_y'].to_numpy()))
         new_small = (
             merged.assign(begin=merged["begin_x"] - merged["begin_y"], end=merged["end_x"] - merged["begin_y"])
                 .astype({"begin": int, "end": int})[[*doc_id_cols, *(merged_id_cols or ()), *small_id_cols, *small_val_cols, "begin", "end"]])
         if new_id_name:
-            new_small[new_id_name] = new_small[new_id_name].astype(str)
-            new_small[new_id_name] = new_small[new_id_name].str.zfill(new_small[new_id_name].str.len().max())
+            new_small[new_id_name] = format_ids(new_small[new_id_name])
             new_small[original_new_id_name] = join_cols(new_small[doc_id_cols + ([new_id_name] if new_id_name not in doc_id_cols else [])], "/")
             new_small = new_small.drop(columns={*doc_id_cols, new_id_name} - {original_new_id_name})
 
@@ -498,14 +763,12 @@ def partition_spans(smalls, large,
 
     if original_new_id_name:
         if new_id_name:
-            large[new_id_name] = large[new_id_name].astype(str)
-            large[new_id_name] = large[new_id_name].str.zfill(large[new_id_name].str.len().max())
+            large[new_id_name] = format_ids(large[new_id_name])
             large[original_new_id_name] = join_cols(large[doc_id_cols + [new_id_name]], "/")
             large = large.drop(columns={*doc_id_cols, new_id_name} - {original_new_id_name})
             new_doc_id_cols = [c if c != original_new_id_name else f'_{c}' for c in doc_id_cols]
 
-            old_to_new[new_id_name] = old_to_new[new_id_name].astype(str)
-            old_to_new[new_id_name] = old_to_new[new_id_name].str.zfill(old_to_new[new_id_name].str.len().max())
+            old_to_new[new_id_name] = format_ids(old_to_new[new_id_name])
             (old_to_new[original_new_id_name],
              old_to_new[new_doc_id_cols],
              ) = (
@@ -520,8 +783,17 @@ def partition_spans(smalls, large,
 
 
 def join_cols(df, sep="/"):
-    df = df.astype(str)
-    return reduce(lambda x, y: x + sep + y, (df.iloc[:, i] for i in range(1, len(df.columns))), df.iloc[:, 0])
+    columns = []
+    for _, col in df.items():
+        if hasattr(col, 'cat'):
+            # Only convert the categories to str, missing values (code -1) are converted as "nan" like astype(str) does
+            columns.append(np.asarray([*col.cat.categories.astype(str), "nan"], dtype=object)[col.cat.codes.to_numpy()])
+        elif col.dtype.kind in "iubO":
+            columns.append(list(map(str, col.tolist())))
+        else:
+            columns.append(col.astype(str).tolist())
+    return pd.Series([sep.join(values) for values in zip(*columns)], index=df.index, dtype=object,
+                     name=df.columns[0] if len(df.columns) == 1 else None)
 
 
 def split_into_spans(large, small, overlap_policy="split_small", pos_col=None):
@@ -26,7 +26,6 @@ if __name__ == "__main__":
         install_requires=[
             'numpy>=1.17.4',
             'pandas>=0.24.1',
-            'pathos>=0.2.5',
             'python-dotenv>=0.10.3',
             'PyYAML>=5.2',
             'scikit-learn>=0.22',